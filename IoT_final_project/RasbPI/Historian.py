@@ -1,10 +1,15 @@
 import paho.mqtt.client as mqtt
+import json
+import math
 import sqlite3
 import os
 import signal
 import sys
 import time
 from datetime import datetime
+from health import ServiceStats, HealthCache, publish_heartbeat, clear_heartbeat
+import alerts
+from profiling import Profiler
 
 # PID and heartbeat files for monitoring
 PID_FILE = "/var/lib/iot_system/historian.pid"
@@ -14,7 +19,12 @@ MQTT_BROKER = "localhost"
 MQTT_PORT = 1883
 MQTT_TOPIC = "#"
 MQTT_CLIENT_ID = "historian-client"
-DB_FILE = "/var/lib/iot_system/historian_data.db"
+DB_FILE = os.environ.get("HISTORIAN_DB", "/var/lib/iot_system/historian_data.db")  # web.py reads the same variable
+
+stats = ServiceStats()
+health_cache = HealthCache()
+alert_evaluator = alerts.AlertEvaluator(alerts.load_rules())
+profiler = Profiler("historian") # idle until kill -USR1 <pid>
 
 def save_pid():
     """Save process ID to file for monitoring"""
@@ -40,38 +50,89 @@ def on_connect(client, userdata, flags, rc):
     
     
 def on_message(client, userdata, msg):
+    if health_cache.handles(msg.topic) or msg.topic.startswith(alerts.ALERT_TOPIC + "/"):
+        return  # heartbeats are status and alerts go in the events table, neither is data worth keeping
     print("Got a message")
-    payload = msg.payload.decode()  # Convert bytes to string
-    topic = msg.topic
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    save_to_database(topic, payload, timestamp)
+    stats.message_started()
+    try:
+        payload = msg.payload.decode()  # Convert bytes to string
+        topic = msg.topic
+        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        save_to_database(topic, payload, timestamp)
+        for event in alert_evaluator.evaluate(topic, payload, time.time()):
+            publish_alert(client, event, timestamp)
+    except Exception as e:
+        stats.error(e)
+        raise
+    finally:
+        stats.message_done()
     
     
+def to_value(message):
+    """The message as a finite number, None if it isn't one. Used for new rows and the backfill, so both agree."""
+    try:
+        value = float(message)
+    except (TypeError, ValueError):
+        return None
+    return value if math.isfinite(value) else None
+
+def init_database():
+    """Create the table and switch to WAL so the dashboard can read while we write (the setting stays with the file)"""
+    conn = sqlite3.connect(DB_FILE)
+    conn.execute("PRAGMA journal_mode=WAL;")  # first, it can't be changed once the backfill below opens a transaction
+    conn.execute("CREATE TABLE IF NOT EXISTS historian_data (topic TEXT, message TEXT, timestamp TEXT, value REAL);")
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(historian_data);")]
+    if "value" not in columns:
+        # databases from before the typed column: add it and fill it in once for the old rows
+        print("Adding numeric value column to historian_data...")
+        conn.execute("ALTER TABLE historian_data ADD COLUMN value REAL;")
+        conn.create_function("to_value", 1, to_value, deterministic=True)
+        conn.execute("UPDATE historian_data SET value = to_value(message);")
+    # the dashboard always asks for a topic (and usually a time range)
+    conn.execute("CREATE INDEX IF NOT EXISTS historian_topic_time ON historian_data (topic, timestamp);")
+    conn.execute("CREATE TABLE IF NOT EXISTS events (timestamp TEXT, rule TEXT, kind TEXT, topic TEXT, state TEXT, value REAL, detail TEXT);")
+    conn.commit()
+    conn.close()
+
 def save_to_database(topic, payload, timestamp):
     conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
 
-    SQL = "CREATE TABLE IF NOT EXISTS historian_data (topic TEXT, message TEXT, timestamp TEXT);"
+    SQL = "CREATE TABLE IF NOT EXISTS historian_data (topic TEXT, message TEXT, timestamp TEXT, value REAL);"
     cursor.execute(SQL)
 
-    SQL = "INSERT INTO historian_data (topic, message, timestamp) VALUES (?,?,?);"
-    cursor.execute(SQL, (topic, payload, timestamp))
+    # value is the message as a number (NULL if it isn't one) so statistics don't have to CAST every row
+    SQL = "INSERT INTO historian_data (topic, message, timestamp, value) VALUES (?,?,?,?);"
+    cursor.execute(SQL, (topic, payload, timestamp, to_value(payload)))
 
     conn.commit()  # Commit ensures data is saved
     conn.close()
     
+def publish_alert(client, event, timestamp):
+    """Only called when an alert starts or stops, so the extra write doesn't happen per message"""
+    print(f"Alert {event['rule']} {event['state']} on {event['topic']}: {event['detail']}")
+    client.publish(f"{alerts.ALERT_TOPIC}/{event['rule']}", json.dumps(dict(event, timestamp=timestamp)))
+    
+    conn = sqlite3.connect(DB_FILE)
+    SQL = "INSERT INTO events (timestamp, rule, kind, topic, state, value, detail) VALUES (?,?,?,?,?,?,?);"
+    conn.execute(SQL, (timestamp, event['rule'], event['kind'], event['topic'], event['state'], event['value'], event['detail']))
+    conn.commit()
+    conn.close()
+    
 if __name__ == "__main__":
     # Register signal handlers for graceful shutdown
     signal.signal(signal.SIGTERM, signal_handler)
     signal.signal(signal.SIGINT, signal_handler)
+    profiler.install_signal() # SIGUSR1 starts/stops profiling
     
     # Save PID for monitoring
     save_pid()
+    init_database()
     
     # Create MQTT client
     client = mqtt.Client(client_id=MQTT_CLIENT_ID)
     client.on_connect = on_connect
-    client.on_message = on_message
+    client.on_message = profiler.timed("on_message")(on_message)
     
     # Connect and start
     try:
@@ -82,6 +143,7 @@ if __name__ == "__main__":
         # Main loop - update heartbeat every 5 seconds
         while True:
             update_heartbeat()
+            publish_heartbeat(client, "historian", stats)
             time.sleep(5)
             
     except KeyboardInterrupt:
@@ -89,8 +151,9 @@ if __name__ == "__main__":
     except Exception as e:
         print(f"Error: {e}")
     finally:
+        clear_heartbeat(client, "historian")
+        client.disconnect()  # queued after the heartbeat clear so it still goes out
         client.loop_stop()
-        client.disconnect()
         if os.path.exists(HEARTBEAT_FILE):
             os.remove(HEARTBEAT_FILE)
         print("Historian shut down cleanly.")
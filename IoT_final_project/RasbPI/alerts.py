@@ -0,0 +1,162 @@
+import json
+import math
+import os
+from collections import deque
+
+# Alerts worked out by the historian as messages come in, instead of something polling historian_data.
+# Each rule keeps a small rolling window per topic with a running mean and variance, so every sample costs O(1) and
+# nothing is read back from the database. An alert is only published when a rule starts or stops firing.
+#
+# Rules come from alerts.json if it exists (same format as DEFAULT_RULES), otherwise DEFAULT_RULES.
+#   threshold: moving average over "window" samples goes "above" and/or "below" a value
+#   zscore:    sample is more than "z" standard deviations from the previous "window" samples
+#   rate:      value changes faster than "max_rate" units per second
+
+ALERTS_FILE = "alerts.json"
+ALERT_TOPIC = "system/alerts" # alerts are published on system/alerts/<rule name>
+
+DEFAULT_RULES = [
+    {"name": "obstacle-close", "topic": "robot/telemetry/distance-ahead", "kind": "threshold", "below": 10, "window": 3},
+    {"name": "distance-outlier", "topic": "robot/telemetry/#", "kind": "zscore", "z": 4, "window": 50},
+    {"name": "distance-jump", "topic": "robot/telemetry/distance-ahead", "kind": "rate", "max_rate": 2000},
+]
+
+
+def topic_matches(pattern, topic):
+    """MQTT style matching, + is one level and # is everything below"""
+    pattern_levels = pattern.split("/")
+    topic_levels = topic.split("/")
+    for i, level in enumerate(pattern_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels) or (level != "+" and level != topic_levels[i]):
+            return False
+    return len(pattern_levels) == len(topic_levels)
+
+def load_rules(filename=ALERTS_FILE):
+    if not os.path.exists(filename):
+        return DEFAULT_RULES
+    with open(filename, 'r') as file:
+        return json.load(file)
+
+
+class RollingWindow:
+    """
+    Last n values with a running mean and variance (Welford's update, with the oldest value taken back out when
+    the window is full), so mean and stddev don't need a loop. Once every n samples they are recomputed from the
+    window, so rounding errors can't pile up over weeks of uptime.
+    """
+
+    def __init__(self, size):
+        self.values = deque(maxlen=size)
+        self.mean_value = 0.0
+        self.m2 = 0.0 # sum of squared differences from the mean
+        self.pushes = 0
+
+    def push(self, value):
+        self.pushes += 1
+        if self.full():
+            old = self.values[0]
+            self.values.append(value)
+            mean = self.mean_value + (value - old) / len(self.values)
+            self.m2 += (value - old) * (value - mean + old - self.mean_value)
+            self.mean_value = mean
+            if self.pushes % self.values.maxlen == 0:
+                self.recompute()
+        else:
+            self.values.append(value)
+            delta = value - self.mean_value
+            self.mean_value += delta / len(self.values)
+            self.m2 += delta * (value - self.mean_value)
+
+    def recompute(self):
+        self.mean_value = sum(self.values) / len(self.values)
+        self.m2 = sum((v - self.mean_value) ** 2 for v in self.values)
+
+    def full(self):
+        return len(self.values) == self.values.maxlen
+
+    def mean(self):
+        return self.mean_value
+
+    def stddev(self):
+        return math.sqrt(max(self.m2 / len(self.values), 0.0))
+
+
+class AlertEvaluator:
+
+    def __init__(self, rules=None):
+        self.rules = DEFAULT_RULES if rules is None else rules
+        self.state = {} # (rule name, topic) -> window / last sample / whether the rule is firing
+        self.matching = {} # topic -> rules that apply to it, worked out the first time the topic is seen
+
+    def rules_for(self, topic):
+        if topic not in self.matching:
+            self.matching[topic] = [rule for rule in self.rules if topic_matches(rule["topic"], topic)]
+        return self.matching[topic]
+
+    def evaluate(self, topic, payload, now):
+        """Feed one message in, get back the alerts that started or stopped because of it"""
+        rules = self.rules_for(topic)
+        if not rules:
+            return []
+        try:
+            value = float(payload)
+        except ValueError:
+            return []
+        if not math.isfinite(value):
+            return [] # one "nan" or "inf" would poison the rule's window for good
+
+        events = []
+        for rule in rules:
+            key = (rule["name"], topic)
+            state = self.state.get(key)
+            if state is None:
+                state = self.state[key] = {"window": RollingWindow(rule.get("window", 1)), "last": None, "active": False}
+
+            firing, detail = self.check(rule, state, value, now)
+            if firing is not None and firing != state["active"]:
+                state["active"] = firing
+                events.append({
+                    "rule": rule["name"],
+                    "kind": rule["kind"],
+                    "topic": topic,
+                    "state": "raised" if firing else "cleared",
+                    "value": value,
+                    "detail": detail,
+                })
+        return events
+
+    def check(self, rule, state, value, now):
+        """Whether the rule is firing (None = not enough data yet) and a short explanation"""
+        window = state["window"]
+        kind = rule["kind"]
+
+        if kind == "threshold":
+            window.push(value)
+            mean = window.mean()
+            if "above" in rule and mean > rule["above"]:
+                return True, f"average {mean:.2f} above {rule['above']}"
+            if "below" in rule and mean < rule["below"]:
+                return True, f"average {mean:.2f} below {rule['below']}"
+            return False, f"average {mean:.2f}"
+
+        if kind == "zscore":
+            # compare against the samples before this one, so a spike can't hide itself
+            result = None, ""
+            if window.full():
+                std = window.stddev()
+                z = abs(value - window.mean()) / std if std > 0 else 0.0
+                result = z > rule["z"], f"z-score {z:.2f}"
+            window.push(value)
+            return result
+
+        if kind == "rate":
+            last = state["last"]
+            state["last"] = (now, value)
+            if last is None or now <= last[0]:
+                return None, ""
+            rate = (value - last[1]) / (now - last[0])
+            return abs(rate) > rule["max_rate"], f"changing {rate:.1f}/s"
+
+        return None, ""
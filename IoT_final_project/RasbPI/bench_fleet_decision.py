@@ -0,0 +1,77 @@
+import sys
+import time
+import numpy as np
+from fleet_decision import FleetDecision, MOVE_NAMES, ULTRA_NAMES
+from robot_simulator import ControllerBackend, DISTANCE_TOPIC, START_TOPIC
+
+# Compares the batched FleetDecision.tick against the real IoT_Controller.on_message handling every robot
+# one message at a time, so the check fails as soon as controller.py and fleet_decision.py drift apart.
+# usage: python bench_fleet_decision.py [robots] [ticks]
+
+def random_readings(n_robots, n_ticks, seed=0):
+    """Readings from 0-255 cm like the ultrasonic sensor, with plenty under 45 so the robots actually turn"""
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 256, size=(n_ticks, n_robots)).astype(float)
+
+class NoRobots:
+    """ControllerBackend wants a simulator to pass the controller's commands to, here they are only recorded by it"""
+
+    def __init__(self, n_robots):
+        self.n_robots = n_robots
+
+    def command(self, robot_id, topic, payload):
+        pass
+
+def run_controller(readings):
+    n_robots = readings.shape[1]
+    backend = ControllerBackend(NoRobots(n_robots))
+    for robot_id in range(n_robots):
+        backend.deliver(robot_id, START_TOPIC, "begin obstacle avoidance")
+    decisions = []
+    start = time.perf_counter()
+    for row in readings:
+        tick = []
+        for robot_id, value in enumerate(row.tolist()):
+            backend.deliver(robot_id, DISTANCE_TOPIC, int(value))
+            state = backend.states[robot_id]
+            tick.append((state["moveInstruction"], state["ultraInstruction"]))
+        decisions.append(tick)
+    return time.perf_counter() - start, decisions
+
+def run_batched(readings):
+    n_robots = readings.shape[1]
+    fleet = FleetDecision(n_robots)
+    ids = np.arange(n_robots)
+    fleet.begin_obstacle_avoidance(ids)
+    decisions = []
+    start = time.perf_counter()
+    for row in readings:
+        decisions.append(fleet.tick(ids, row))
+    return time.perf_counter() - start, decisions
+
+def same_decisions(controller, batched):
+    for controller_row, (move, ultra) in zip(controller, batched):
+        for (controller_move, controller_ultra), m, u in zip(controller_row, move, ultra):
+            if controller_move != MOVE_NAMES[m] or controller_ultra != ULTRA_NAMES[u]:
+                return False
+    return True
+
+if __name__ == "__main__":
+    n_robots = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    n_ticks = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    readings = random_readings(n_robots, n_ticks)
+    controller_time, controller_decisions = run_controller(readings)
+    batched_time, batched_decisions = run_batched(readings)
+
+    messages = n_robots * n_ticks
+    print(f"{n_robots} robots x {n_ticks} ticks = {messages} readings")
+    print(f"  controller: {controller_time:.4f}s ({controller_time / messages * 1e6:.2f} us/reading)")
+    print(f"  batched:    {batched_time:.4f}s ({batched_time / messages * 1e6:.2f} us/reading)")
+    print(f"  speedup:    {controller_time / batched_time:.1f}x")
+
+    if same_decisions(controller_decisions, batched_decisions):
+        print("✓ Batched decisions match IoT_Controller.on_message")
+    else:
+        print("✗ Batched decisions differ from IoT_Controller.on_message")
+        sys.exit(1)
@@ -0,0 +1,44 @@
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Cold start time of the services, i.e. how long systemd waits after a restart before they are up.
+# Each run is a fresh interpreter. Neither needs the broker to be running, both connect in the background.
+# usage: python bench_startup.py [runs]
+
+TARGET = 1.0 # seconds
+
+STARTUPS = {
+    "web.py": "import web; web.create_app()",
+    "controller.py": "import controller; controller.IoT_Controller.configure(); controller.IoT_Controller.run()",
+}
+
+def time_startup(code, scratch):
+    """Wall time of a whole interpreter doing the startup work, plus the time measured inside it"""
+    inner = f"import time; t = time.perf_counter(); {code}; print(time.perf_counter() - t)"
+    # the rule store is created on startup, keep it out of the source tree and away from the real one
+    env = dict(os.environ, RULES_DB=os.path.join(scratch, "rules.db"))
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", inner], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+    total = time.perf_counter() - start
+    return total, float(result.stdout.strip().splitlines()[-1])
+
+if __name__ == "__main__":
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    ok = True
+    with tempfile.TemporaryDirectory() as scratch:
+        for name, code in STARTUPS.items():
+            totals, imports = zip(*(time_startup(code, scratch) for _ in range(runs)))
+            total = statistics.median(totals)
+            print(f"{name}: {total:.3f}s process start to ready, {statistics.median(imports):.3f}s of that importing/configuring (median of {runs})")
+            if total >= TARGET:
+                print(f"  ⚠ over the {TARGET:.1f}s target")
+                ok = False
+    if ok:
+        print(f"✓ All services start in under {TARGET:.1f}s")
+    else:
+        sys.exit(1)
@@ -1,4 +1,3 @@
-import paho.mqtt.client as mqtt
 import json
 import time
 import logging
@@ -8,6 +7,10 @@ import sys
 from http.server import HTTPServer, BaseHTTPRequestHandler
 import threading
 from datetime import datetime
+from health import ServiceStats, HealthCache, heartbeat_age, publish_heartbeat, clear_heartbeat
+from rule_store import RuleStore, RULES_DB, RULES_CHANGED_TOPIC
+from profiling import Profiler
+from alerts import ALERT_TOPIC
 
 # Configuration
 RULES_FILE = "/opt/iot_system/rules.json"
@@ -23,6 +26,8 @@ distanceRight = -1
 distanceForward = 255
 
 
+profiler = Profiler("controller") # idle until kill -USR1 <pid>
+
 # Monitoring files
 PID_FILE = "/var/lib/iot_system/controller.pid"
 HEARTBEAT_FILE = "/var/lib/iot_system/controller.heartbeat"
@@ -40,9 +45,13 @@ logging.basicConfig(
 
 class IoT_Controller: 
     client = None
-    rules = []
+    rule_store = None
+    rules = {} # rule id -> rule, as stored in the rule store
+    rules_seq = 0 # newest rule store change we have loaded
     mqtt_data = {}
     message_log = []
+    stats = ServiceStats()
+    health = HealthCache()
     
     
    
@@ -50,15 +59,18 @@ class IoT_Controller:
     def configure():
         
 
-        filename = "rules.json"
-        with open(filename,'r') as file:
-            IoT_Controller.rules = json.load(file)
+        IoT_Controller.rule_store = RuleStore(RULES_DB, import_from="rules.json")
+        e = IoT_Controller.load_rules()
+        if e != None:
+            print(f"✗ Error loading rules: {e}")
         #print (IoT_Controller.rules)
 
+        import paho.mqtt.client as mqtt # imported here so importing the controller stays fast
         IoT_Controller.client = mqtt.Client()
-        IoT_Controller.client.on_message = IoT_Controller.on_message
-        IoT_Controller.client.connect("localhost",1883)
-        IoT_Controller.client.subscribe("#")
+        IoT_Controller.client.on_connect = IoT_Controller.on_connect
+        IoT_Controller.client.on_message = profiler.timed("on_message")(IoT_Controller.handle_message)
+        # connects in the background once run() starts the loop and keeps retrying, so a broker that is still starting doesn't kill us
+        IoT_Controller.client.connect_async(MQTT_BROKER, MQTT_PORT)
         
         '''broker_host = "mqtt.example.com"
         broker_port = 8883  # Secure MQTT
@@ -66,6 +78,53 @@ class IoT_Controller:
         '''
     
     
+    def load_rules():
+        """Load every rule from the rule store. Returns None on success or the exception, for the reload endpoints."""
+        try:
+            seq = IoT_Controller.rule_store.last_change()
+            IoT_Controller.rules = {rule["id"]: rule for rule in IoT_Controller.rule_store.all()}
+            IoT_Controller.rules_seq = seq
+            return None
+        except Exception as e:
+            return e
+    
+    def apply_rule_changes():
+        """Reload only the rules changed since the last load, web.py announces each change on RULES_CHANGED_TOPIC"""
+        try:
+            changed, seq = IoT_Controller.rule_store.changes_since(IoT_Controller.rules_seq)
+            for rule_id in changed:
+                rule = IoT_Controller.rule_store.get(rule_id)
+                if rule is None:
+                    IoT_Controller.rules.pop(rule_id, None)
+                else:
+                    IoT_Controller.rules[rule_id] = rule
+            IoT_Controller.rules_seq = seq
+            print(f"✓ Reloaded {len(changed)} changed rule(s) ({len(IoT_Controller.rules)} rules)")
+        except Exception as e:
+            print(f"✗ Error reloading changed rules: {e}")
+    
+    def on_connect(client, userdata, flags, rc):
+        client.subscribe("#") # subscribing here means we subscribe again after a reconnect
+    
+    def handle_message(client, userdata, message):
+        """Heartbeats from the other services go to the health cache, everything else goes through on_message"""
+        if IoT_Controller.health.handles(message.topic):
+            IoT_Controller.health.update(message.topic, message.payload.decode("utf-8"))
+            return
+        if message.topic == RULES_CHANGED_TOPIC:
+            IoT_Controller.apply_rule_changes()
+            return
+        if message.topic.startswith(ALERT_TOPIC + "/"):
+            return # the historian's alerts aren't robot traffic, on_message would resend the drive instructions for them
+        IoT_Controller.stats.message_started()
+        try:
+            IoT_Controller.on_message(client, userdata, message)
+        except Exception as e:
+            IoT_Controller.stats.error(e)
+            raise
+        finally:
+            IoT_Controller.stats.message_done()
+    
     def on_message(client, userdata, message):
         global inAutoMode
         global moveInstruction
@@ -165,7 +224,7 @@ class IoT_Controller:
             IoT_Controller.client.publish("robot/behaviour/ultrasonic-sensor", ultraInstruction)
         
         #we dont need the rules anymore since the decision making is hard-coded. Th rules system was limiting due to only one action per rule and needing to spam MQTT to transmit many variables.
-        """for rule in IoT_Controller.rules: # the rules itself is a dictionary, where every rule has some values (in this case an array of conditions (each of which is its own dictionary of values) & a dictionary of action values)
+        """for rule in IoT_Controller.rules.values(): # the rules itself is a dictionary, where every rule has some values (in this case an array of conditions (each of which is its own dictionary of values) & a dictionary of action values)
             conditions = rule["conditions"] # array of condition dictionaries, each of which contains the values for the given condition
             conditions_met = True
             #print(rule)
@@ -308,27 +367,39 @@ def update_heartbeat():
     with open(HEARTBEAT_FILE, 'w') as f:
         f.write(datetime.now().isoformat())
 
+historian_healthy = None # result of the last check, so the main loop only reports changes
+
 def check_historian_health():
-    """Check if historian is running by reading its heartbeat"""
+    """
+    Check if historian is running by reading its heartbeat (MQTT heartbeat if we have one, otherwise the file).
+    Called from the main loop once the client is connected, and only prints when the answer changes.
+    """
+    global historian_healthy
     try:
-        with open(HISTORIAN_HEARTBEAT, 'r') as f:
-            last_beat = f.read().strip()
-            # Parse timestamp
-            last_time = datetime.fromisoformat(last_beat)
-            age_seconds = (datetime.now() - last_time).seconds
-            
-            if age_seconds < 15:
+        beat = IoT_Controller.health.get("historian")
+        if beat is not None:
+            last_beat = beat["timestamp"]
+        else:
+            with open(HISTORIAN_HEARTBEAT, 'r') as f:
+                last_beat = f.read().strip()
+        age_seconds = heartbeat_age(last_beat)
+        
+        healthy = age_seconds < 15
+        if healthy != historian_healthy:
+            if healthy:
                 print(f"✓ Historian is healthy (heartbeat {age_seconds}s ago)")
-                return True
             else:
                 print(f"⚠ WARNING: Historian heartbeat is {age_seconds}s old - may be dead!")
-                return False
     except FileNotFoundError:
-        print("✗ ERROR: Historian heartbeat file not found - Historian may not be running!")
-        return False
+        healthy = False
+        if historian_healthy is not False:
+            print("✗ ERROR: Historian heartbeat file not found - Historian may not be running!")
     except Exception as e:
-        print(f"✗ ERROR checking historian: {e}")
-        return False
+        healthy = False
+        if historian_healthy is not False:
+            print(f"✗ ERROR checking historian: {e}")
+    historian_healthy = healthy
+    return healthy
     
 
 
@@ -337,13 +408,11 @@ if __name__ == "__main__":
     signal.signal(signal.SIGHUP, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
     signal.signal(signal.SIGINT, signal_handler)
+    profiler.install_signal() # SIGUSR1 starts/stops profiling
     
     # Save PID
     save_pid()
     
-    # Check if historian is running
-    check_historian_health()
-    
     # Configure and start controller
     IoT_Controller.configure()
     IoT_Controller.run()  # Starts MQTT in background
@@ -356,11 +425,14 @@ if __name__ == "__main__":
     print(f"  - MQTT: {MQTT_BROKER}:{MQTT_PORT}")
     print(f"  - HTTP reload: http://localhost:5001/reload")
     print(f"  - Manual reload: kill -HUP {os.getpid()}")
+    print(f"  - Profiling: kill -USR1 {os.getpid()} to start, again to stop and dump")
     
     # Main loop with heartbeat
     try:
         while True:
             update_heartbeat()
+            publish_heartbeat(IoT_Controller.client, "controller", IoT_Controller.stats)
+            check_historian_health() # after connecting, so the historian's MQTT heartbeat can be used
             #publishMovement()
             
             time.sleep(5) # maybe lower this is the heartbeat function permits
@@ -369,6 +441,9 @@ if __name__ == "__main__":
     finally:
         if os.path.exists(HEARTBEAT_FILE):
             os.remove(HEARTBEAT_FILE)
+        clear_heartbeat(IoT_Controller.client, "controller")
+        IoT_Controller.client.disconnect()
+        IoT_Controller.client.loop_stop()
         print("IoT Controller shut down cleanly")    
     
         
@@ -0,0 +1,105 @@
+import numpy as np
+
+# Batched version of the obstacle avoidance state machine in controller.py (IoT_Controller.on_message).
+# Every robot in the fleet gets one slot in each array, and a tick evaluates the decision for every robot
+# that has a new "robot/telemetry/distance-ahead" reading at the same time instead of one message at a time.
+
+CLEAR_DISTANCE = 45 # cm, same threshold the controller uses to decide the path ahead is clear
+
+# move instructions, stored as small ints in the arrays. The index is the code, the string is what gets published.
+MOVE_FORWARD = 0
+MOVE_STOP = 1
+MOVE_LEFT = 2
+MOVE_RIGHT = 3
+MOVE_UTURN = 4
+MOVE_NAMES = ["move forward", "stop", "move left", "move right", "u-turn"]
+
+# ultrasonic sensor instructions
+READ_FORWARD = 0
+READ_LEFT = 1
+READ_RIGHT = 2
+COMPARE = 3
+ULTRA_NAMES = ["read forward", "read left", "read right", "compare"]
+
+
+class FleetDecision:
+    """Holds the obstacle avoidance state of N robots in NumPy arrays"""
+
+    def __init__(self, n_robots):
+        self.n_robots = n_robots
+        self.auto_mode = np.zeros(n_robots, dtype=bool)
+        self.move = np.full(n_robots, MOVE_FORWARD, dtype=np.int8)
+        self.ultra = np.full(n_robots, READ_FORWARD, dtype=np.int8)
+        self.distance_left = np.full(n_robots, -1.0)
+        self.distance_right = np.full(n_robots, -1.0)
+        self.distance_forward = np.full(n_robots, 255.0)
+
+    def begin_obstacle_avoidance(self, robot_ids):
+        """Same reset as the controller gets on 'begin obstacle avoidance' (robots already in auto mode are left alone)"""
+        ids = np.asarray(robot_ids, dtype=np.intp)
+        ids = ids[~self.auto_mode[ids]]
+        self.auto_mode[ids] = True
+        self.distance_left[ids] = -1
+        self.distance_right[ids] = -1
+        self.move[ids] = MOVE_FORWARD
+        self.ultra[ids] = READ_FORWARD
+
+    def stop(self, robot_ids):
+        """Manual 'stop' takes the robots out of auto mode"""
+        self.auto_mode[np.asarray(robot_ids, dtype=np.intp)] = False
+
+    def tick(self, robot_ids, distances):
+        """
+        Apply one distance reading to each robot in robot_ids and return the (move, ultra) codes to publish for them.
+        A robot id must appear at most once per tick, queue extra readings for the next tick.
+        """
+        ids = np.asarray(robot_ids, dtype=np.intp)
+        value = np.asarray(distances, dtype=float)
+
+        move = self.move[ids]
+        ultra = self.ultra[ids]
+        left = self.distance_left[ids]
+        right = self.distance_right[ids]
+        forward = self.distance_forward[ids]
+
+        # moving forward: store the reading, keep going if it is clear, otherwise stop and look left
+        # (the controller never resets the ultrasonic instruction here, so neither do we)
+        going_forward = move == MOVE_FORWARD
+        clear = going_forward & (value >= CLEAR_DISTANCE)
+        blocked = going_forward & ~clear
+        forward = np.where(going_forward, value, forward)
+        left = np.where(clear, -1.0, left)
+        right = np.where(clear, -1.0, right)
+        move = np.where(blocked, MOVE_STOP, move)
+
+        # stopped: the next reading is the left distance, then the right distance
+        read_left = ~going_forward & (ultra == READ_LEFT) & (left == -1)
+        read_right = ~going_forward & (ultra == READ_RIGHT) & (right == -1)
+        left = np.where(read_left, value, left)
+        right = np.where(read_right, value, right)
+        ultra = np.where(blocked, READ_LEFT, ultra)
+        ultra = np.where(read_left, READ_RIGHT, ultra)
+        ultra = np.where(read_right, COMPARE, ultra)
+
+        # once both sides are known pick the direction, on the same tick the right distance arrives
+        compare = (left > -1) & (right > -1) & (move == MOVE_STOP)
+        u_turn = (forward > left) & (forward > right)
+        decision = np.where(u_turn, MOVE_UTURN, np.where(left > right, MOVE_LEFT, MOVE_RIGHT))
+        turning = ~compare & ((move == MOVE_LEFT) | (move == MOVE_RIGHT) | (move == MOVE_UTURN))
+        done_turning = turning & (value >= CLEAR_DISTANCE)
+        move = np.where(compare, decision, move)
+        move = np.where(done_turning, MOVE_FORWARD, move)
+        ultra = np.where(done_turning, READ_FORWARD, ultra)
+
+        self.move[ids] = move
+        self.ultra[ids] = ultra
+        self.distance_left[ids] = left
+        self.distance_right[ids] = right
+        self.distance_forward[ids] = forward
+        return move, ultra
+
+    def instructions(self, robot_ids):
+        """Turn the codes back into the strings the controller publishes, only for robots in auto mode"""
+        ids = np.asarray(robot_ids, dtype=np.intp)
+        return [(int(i), MOVE_NAMES[self.move[i]], ULTRA_NAMES[self.ultra[i]]) for i in ids if self.auto_mode[i]]
+
@@ -0,0 +1,93 @@
+import json
+import os
+import time
+from datetime import datetime
+
+# Service heartbeats over MQTT. Every 5 seconds the historian and controller publish a retained message on
+# system/health/<service> with their load numbers, and anything that wants to know if they are alive keeps
+# the latest one in a HealthCache instead of opening the heartbeat files each time.
+
+HEALTH_TOPIC = "system/health"
+
+
+def health_topic(service):
+    return f"{HEALTH_TOPIC}/{service}"
+
+def heartbeat_age(timestamp):
+    """Seconds since an isoformat timestamp (total_seconds, .seconds wraps around after a day)"""
+    return int((datetime.now() - datetime.fromisoformat(timestamp)).total_seconds())
+
+
+class ServiceStats:
+    """Counters a service updates as it handles messages, turned into a heartbeat every few seconds"""
+
+    def __init__(self):
+        self.messages_total = 0
+        # messages being handled right now. paho runs callbacks one at a time, so this is 0 or 1 and only says
+        # whether the service is busy at heartbeat time, it is not a queue depth
+        self.in_progress = 0
+        self.last_error = None
+        self.last_error_time = None
+        self._last_count = 0
+        self._last_time = time.monotonic()
+
+    def message_started(self):
+        self.messages_total += 1
+        self.in_progress += 1
+
+    def message_done(self):
+        self.in_progress -= 1
+
+    def error(self, e):
+        self.last_error = str(e)
+        self.last_error_time = datetime.now().isoformat()
+
+    def heartbeat(self, service):
+        """Build the heartbeat payload, the ingest rate covers the time since the previous heartbeat"""
+        now = time.monotonic()
+        elapsed = now - self._last_time
+        rate = (self.messages_total - self._last_count) / elapsed if elapsed > 0 else 0.0
+        self._last_count = self.messages_total
+        self._last_time = now
+        return {
+            "service": service,
+            "pid": os.getpid(),
+            "timestamp": datetime.now().isoformat(),
+            "ingest_rate": round(rate, 2),
+            "messages_total": self.messages_total,
+            "in_progress": self.in_progress,
+            "last_error": self.last_error,
+            "last_error_time": self.last_error_time,
+        }
+
+
+def publish_heartbeat(client, service, stats):
+    """Retained so a subscriber that starts later still gets the latest heartbeat straight away"""
+    client.publish(health_topic(service), json.dumps(stats.heartbeat(service)), qos=1, retain=True)
+
+def clear_heartbeat(client, service):
+    """An empty retained message removes the heartbeat from the broker, same idea as deleting the heartbeat file"""
+    client.publish(health_topic(service), "", qos=1, retain=True)
+
+
+class HealthCache:
+    """Latest heartbeat of each service, fed from a subscription to system/health/#"""
+
+    def __init__(self):
+        self.beats = {} # only ever replaced whole from the MQTT thread, so readers don't need a lock
+
+    def handles(self, topic):
+        return topic.startswith(HEALTH_TOPIC + "/")
+
+    def update(self, topic, payload):
+        service = topic[len(HEALTH_TOPIC) + 1:]
+        if not payload:
+            self.beats.pop(service, None)
+            return
+        try:
+            self.beats[service] = json.loads(payload)
+        except json.JSONDecodeError:
+            print(f"Ignoring bad heartbeat on {topic}: {payload!r}")
+
+    def get(self, service):
+        return self.beats.get(service)
@@ -0,0 +1,65 @@
+import os
+import queue
+import sqlite3
+from urllib.parse import quote
+
+# Read access to the historian database for web.py.
+# A few read-only connections are kept open in a pool shared by every request thread (the dev server starts
+# a new thread per request, so per-thread connections would be opened and thrown away every time), with
+# sqlite's statement cache doing the prepared statement reuse. The historian puts the database in WAL mode,
+# so these reads see the last committed data and don't wait for its writes.
+
+# same file the historian writes to, HISTORIAN_DB overrides it (e.g. for a copy of the data on a laptop)
+DB_FILE = os.environ.get("HISTORIAN_DB", "/var/lib/iot_system/historian_data.db")
+BUSY_TIMEOUT_MS = 5000 # only matters if the database isn't in WAL mode and the historian is mid-write
+CACHED_STATEMENTS = 128
+POOL_SIZE = 4 # idle connections kept, more are opened if more requests run at once and closed afterwards
+
+_pool = queue.Queue(maxsize=POOL_SIZE)
+_journal_checked = False
+
+
+def connect():
+    """Open a new read-only connection, usable from any thread (one thread at a time)"""
+    global _journal_checked
+    conn = sqlite3.connect(f"file:{quote(DB_FILE)}?mode=ro", uri=True, check_same_thread=False,
+                           timeout=BUSY_TIMEOUT_MS / 1000, cached_statements=CACHED_STATEMENTS)
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    if not _journal_checked:
+        _journal_checked = True
+        journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        if journal_mode != "wal":
+            print(f"⚠ {DB_FILE} is in {journal_mode} mode, dashboard reads will wait for historian writes")
+    return conn
+
+def query(sql, params=()):
+    """Run a SELECT on a pooled connection and return all rows. Outside a transaction, so each query sees the latest commit."""
+    try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        conn = connect()
+    try:
+        rows = conn.execute(sql, params).fetchall()
+    except sqlite3.OperationalError:
+        # connection may have gone bad (database replaced, disk error), don't hand it out again
+        conn.close()
+        raise
+    except Exception:
+        _release(conn)
+        raise
+    _release(conn)
+    return rows
+
+def _release(conn):
+    try:
+        _pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+def close():
+    """Close every idle connection, the next query opens a fresh one"""
+    while True:
+        try:
+            _pool.get_nowait().close()
+        except queue.Empty:
+            return
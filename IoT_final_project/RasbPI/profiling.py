@@ -0,0 +1,198 @@
+import gc
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from functools import wraps
+
+# Profiling that can be switched on while a service is running, for when it slows down in the field.
+# Nothing is measured until it is started (kill -USR1 <pid>, or the /debug/profile routes in web.py).
+# While it runs:
+#   - a background thread samples every thread's stack, dumped in the collapsed "a;b;c count" format
+#     that flamegraph.pl and speedscope read
+#   - wrapped callbacks (MQTT on_message, web requests) record their CPU time
+#   - garbage collector pauses are timed per generation
+# Sending USR1 again stops it and writes <service>-<time>.folded and .json to PROFILE_DIR.
+
+PROFILE_DIR = os.environ.get("IOT_PROFILE_DIR", "/var/lib/iot_system/profiles")
+SAMPLE_INTERVAL = 0.005 # seconds between stack samples
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class Profiler:
+
+    def __init__(self, service, interval=SAMPLE_INTERVAL):
+        self.service = service
+        self.interval = interval
+        self.running = False
+        self._thread = None
+        self._stop = threading.Event()
+        self._control = threading.Lock() # start/stop can come from the signal thread and web requests at once
+        self._lock = threading.Lock() # stacks, samples and callbacks, written while the routes read them
+        self._reset()
+
+    def _reset(self):
+        with self._lock:
+            self.stacks = Counter()
+            self.samples = 0
+            self.callbacks = {} # name -> {"calls", "cpu_total", "cpu_max"}
+        self.gc_pauses = {} # generation -> {"collections", "pause_total", "pause_max"}
+        self._gc_start = None
+        self.started_at = None
+        self.stopped_at = None
+
+    def start(self):
+        """Returns False if profiling was already running"""
+        with self._control:
+            if self.running:
+                return False
+            self._reset()
+            self.started_at = time.time()
+            self.running = True
+            gc.callbacks.append(self._gc_callback)
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._sample_loop, name="profiler", daemon=True)
+            self._thread.start()
+        print(f"Profiling {self.service} started")
+        return True
+
+    def _stop_sampling(self):
+        if not self.running:
+            return False
+        self.running = False
+        self._stop.set()
+        self._thread.join()
+        if self._gc_callback in gc.callbacks:
+            gc.callbacks.remove(self._gc_callback)
+        self.stopped_at = time.time()
+        print(f"Profiling {self.service} stopped ({self.samples} samples)")
+        return True
+
+    def stop(self):
+        """Returns False if profiling wasn't running"""
+        with self._control:
+            return self._stop_sampling()
+
+    def stop_and_dump(self, directory=None):
+        """
+        Stop and write the results in one go, so a start from somewhere else can't clear them in between.
+        Returns the path of the dump, None if profiling wasn't running. OSError if the files can't be written.
+        """
+        with self._control:
+            if not self._stop_sampling():
+                return None
+            return self.dump(directory)
+
+    def toggle(self):
+        """Start if stopped, otherwise stop and write the results. Returns the path of the dump when stopping."""
+        with self._control:
+            running = self.running
+        if not running:
+            self.start()
+            return None
+        return self.stop_and_dump()
+
+    def _toggle_from_signal(self):
+        try:
+            self.toggle()
+        except OSError as e:
+            print(f"✗ Could not write profile for {self.service}: {e}")
+
+    def install_signal(self, signum=signal.SIGUSR1):
+        """Toggle profiling with kill -USR1 <pid>. Signal handlers can only be set from the main thread."""
+        try:
+            signal.signal(signum, lambda s, f: threading.Thread(target=self._toggle_from_signal, daemon=True).start())
+        except ValueError:
+            print(f"Profiling signal not installed for {self.service}: not on the main thread")
+
+    def _sample_loop(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(frame_label(frame))
+                    frame = frame.f_back
+                labels.append(names.get(thread_id, str(thread_id)))
+                stacks.append(";".join(reversed(labels)))
+            with self._lock:
+                self.stacks.update(stacks)
+                self.samples += 1
+
+    def _gc_callback(self, phase, info):
+        # no lock here: a collection can start while this thread holds self._lock, and collections
+        # never overlap, so gc_pauses only ever has one writer
+        if phase == "start":
+            self._gc_start = time.perf_counter()
+        elif self._gc_start is not None:
+            pause = time.perf_counter() - self._gc_start
+            self._gc_start = None
+            entry = self.gc_pauses.setdefault(info["generation"], {"collections": 0, "pause_total": 0.0, "pause_max": 0.0})
+            entry["collections"] += 1
+            entry["pause_total"] += pause
+            entry["pause_max"] = max(entry["pause_max"], pause)
+
+    def timed(self, name):
+        """Wrap a callback so its CPU time is recorded while profiling, when not profiling it is just called"""
+        def decorate(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.running:
+                    return func(*args, **kwargs)
+                start = time.thread_time()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.record(name, time.thread_time() - start)
+            return wrapper
+        return decorate
+
+    def record(self, name, cpu):
+        with self._lock:
+            entry = self.callbacks.setdefault(name, {"calls": 0, "cpu_total": 0.0, "cpu_max": 0.0})
+            entry["calls"] += 1
+            entry["cpu_total"] += cpu
+            entry["cpu_max"] = max(entry["cpu_max"], cpu)
+
+    def collapsed_stacks(self):
+        with self._lock:
+            stacks = self.stacks.most_common()
+        return "".join(f"{stack} {count}\n" for stack, count in stacks)
+
+    def report(self):
+        end = self.stopped_at if not self.running and self.stopped_at else time.time()
+        with self._lock:
+            samples = self.samples
+            callbacks = {name: dict(entry, cpu_mean=entry["cpu_total"] / entry["calls"]) for name, entry in self.callbacks.items()}
+        return {
+            "service": self.service,
+            "running": self.running,
+            "seconds": round(end - self.started_at, 3) if self.started_at else 0,
+            "samples": samples,
+            "callbacks": callbacks,
+            "gc": {str(generation): dict(entry) for generation, entry in list(self.gc_pauses.items())},
+        }
+
+    def dump(self, directory=None):
+        """Write the stacks (.folded) and the report (.json), returns the .folded path"""
+        directory = directory or PROFILE_DIR
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, f"{self.service}-{datetime.now().strftime('%Y%m%d-%H%M%S')}")
+        with open(base + ".folded", 'w') as f:
+            f.write(self.collapsed_stacks())
+        with open(base + ".json", 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        print(f"Profile written to {base}.folded")
+        return base + ".folded"
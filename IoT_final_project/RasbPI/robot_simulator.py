@@ -0,0 +1,358 @@
+import argparse
+import io
+import logging
+import os
+import queue
+import time
+from contextlib import redirect_stdout
+import numpy as np
+
+# Headless stand-in for the Elegoo robot + ESP8266 (mqtt_esp8266_robot_client.ino / MQTT_robot_arduino.ino).
+# N robots drive around a 2D obstacle map, follow the drive and ultrasonic commands the controller publishes,
+# and publish "robot/telemetry/distance-ahead" every 100 ms like the ESP does. Everything runs on a simulated
+# clock with a seeded map, so two runs with the same arguments make the same decisions.
+#
+# usage: python robot_simulator.py --robots 1 10 100 --seconds 60 --backend controller|fleet
+#        python robot_simulator.py --seconds 60 --backend broker
+# (the broker backend only runs one robot, controller.py has no per-robot topics to answer a fleet on)
+
+DRIVE_TOPIC = "robot/behaviour/drive"
+ULTRA_TOPIC = "robot/behaviour/ultrasonic-sensor"
+DISTANCE_TOPIC = "robot/telemetry/distance-ahead"
+START_TOPIC = "robot/instruction-request"
+
+TICK = 0.1 # seconds between distance publications, same as the ESP
+FORWARD_SPEED = 30.0 # cm/s
+TURN_SPEED = 90.0 # degrees/s
+ROBOT_RADIUS = 10.0 # cm
+MAX_DISTANCE = 255 # the arduino clamps readings to fit in a byte
+SERVO_DELAY = 0.007 # seconds per degree the servo has to turn before the arduino takes a reading
+
+# drive commands, both the controller's obstacle avoidance strings and the manual ones from the web page
+STOP, FORWARD, BACKWARD, LEFT, RIGHT = range(5)
+DRIVE_COMMANDS = {
+    "stop": STOP,
+    "move forward": FORWARD, "forward": FORWARD,
+    "backward": BACKWARD,
+    "move left": LEFT, "left": LEFT, "u-turn": LEFT,
+    "move right": RIGHT, "right": RIGHT,
+}
+# servo angle relative to the robot's heading. "compare" is not a read command, the arduino ignores it.
+SERVO_ANGLES = {"read forward": 0.0, "read left": 90.0, "read right": -90.0}
+
+
+class ObstacleMap:
+    """Occupancy grid with walls around the edge and seeded random box obstacles"""
+
+    def __init__(self, width=1000, height=1000, cell=5, obstacles=40, seed=0):
+        self.width = width
+        self.height = height
+        self.cell = cell
+        rng = np.random.default_rng(seed)
+        cols, rows = width // cell, height // cell
+        self.grid = np.zeros((rows, cols), dtype=bool)
+        self.grid[0, :] = self.grid[-1, :] = True
+        self.grid[:, 0] = self.grid[:, -1] = True
+        for _ in range(obstacles):
+            w, h = rng.integers(4, 20, size=2)
+            c, r = rng.integers(1, cols - w), rng.integers(1, rows - h)
+            self.grid[r:r + h, c:c + w] = True
+
+    def occupied(self, x, y):
+        col = np.clip((x // self.cell).astype(np.intp), 0, self.grid.shape[1] - 1)
+        row = np.clip((y // self.cell).astype(np.intp), 0, self.grid.shape[0] - 1)
+        return self.grid[row, col]
+
+    def distance(self, x, y, angle):
+        """Vectorized ultrasonic reading: march a ray from each robot along angle (degrees) until it hits something"""
+        steps = np.arange(0, MAX_DISTANCE + ROBOT_RADIUS + self.cell, self.cell / 2)
+        rad = np.radians(angle)[:, None]
+        hit = self.occupied(x[:, None] + np.cos(rad) * steps, y[:, None] + np.sin(rad) * steps)
+        first = np.where(hit.any(axis=1), steps[hit.argmax(axis=1)], np.inf)
+        return np.clip(first - ROBOT_RADIUS, 0, MAX_DISTANCE).astype(int)
+
+    def free_positions(self, n, rng):
+        """Random starting spots with a robot's worth of clearance in every direction"""
+        x, y = np.empty(0), np.empty(0)
+        while len(x) < n:
+            cx = rng.uniform(0, self.width, size=n)
+            cy = rng.uniform(0, self.height, size=n)
+            clear = np.ones(n, dtype=bool)
+            for angle in range(0, 360, 45):
+                clear &= self.distance(cx, cy, np.full(n, float(angle))) > ROBOT_RADIUS
+            x, y = np.concatenate([x, cx[clear]]), np.concatenate([y, cy[clear]])
+        return x[:n], y[:n]
+
+
+class RobotSimulator:
+    """N independent robots sharing one map (they don't collide with each other, only with obstacles)"""
+
+    def __init__(self, n_robots, obstacle_map=None, seed=0):
+        self.n_robots = n_robots
+        self.map = obstacle_map or ObstacleMap(seed=seed)
+        rng = np.random.default_rng(seed)
+        self.x, self.y = self.map.free_positions(n_robots, rng)
+        self.heading = rng.uniform(0, 360, size=n_robots)
+        self.drive = np.full(n_robots, STOP, dtype=np.int8)
+        self.servo = np.zeros(n_robots)
+        self.reading_due = np.full(n_robots, np.inf) # sim time at which the requested reading is taken
+        self.distance = np.full(n_robots, MAX_DISTANCE, dtype=int)
+        self.blocked = np.zeros(n_robots, dtype=bool)
+        self.collisions = 0
+        self.now = 0.0
+
+    def command(self, robot_id, topic, payload):
+        """What the ESP + arduino do with a message from the controller"""
+        if topic == DRIVE_TOPIC and payload in DRIVE_COMMANDS:
+            self.drive[robot_id] = DRIVE_COMMANDS[payload]
+        elif topic == ULTRA_TOPIC and payload in SERVO_ANGLES:
+            angle = SERVO_ANGLES[payload]
+            self.reading_due[robot_id] = self.now + abs(angle - self.servo[robot_id]) * SERVO_DELAY
+            self.servo[robot_id] = angle
+
+    def step(self):
+        """Advance the clock one ESP publish period and return the distance every robot publishes"""
+        self.now += TICK
+        turn = np.select([self.drive == LEFT, self.drive == RIGHT], [TURN_SPEED, -TURN_SPEED], 0.0)
+        self.heading = (self.heading + turn * TICK) % 360
+        speed = np.select([self.drive == FORWARD, self.drive == BACKWARD], [FORWARD_SPEED, -FORWARD_SPEED], 0.0)
+        rad = np.radians(self.heading)
+        new_x = self.x + np.cos(rad) * speed * TICK
+        new_y = self.y + np.sin(rad) * speed * TICK
+        # bumper is on the side the robot is driving towards
+        side = np.where(speed < 0, -ROBOT_RADIUS, ROBOT_RADIUS)
+        hit = (speed != 0) & self.map.occupied(new_x + np.cos(rad) * side, new_y + np.sin(rad) * side)
+        self.collisions += int(np.count_nonzero(hit & ~self.blocked))
+        self.blocked = hit
+        self.x = np.where(hit, self.x, new_x)
+        self.y = np.where(hit, self.y, new_y)
+
+        # the arduino only measures once the servo has had time to reach the requested angle,
+        # until then the ESP keeps publishing the last value it got
+        due = self.reading_due <= self.now
+        if due.any():
+            ids = np.flatnonzero(due)
+            self.distance[ids] = self.map.distance(self.x[ids], self.y[ids], self.heading[ids] + self.servo[ids])
+            self.reading_due[ids] = np.inf
+        return self.distance.copy()
+
+
+class FakeMessage:
+    """Just enough of paho's MQTTMessage for IoT_Controller.on_message"""
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = str(payload).encode("utf-8")
+
+
+class FakeClient:
+    """Stands in for IoT_Controller.client, publications go straight to the simulated robot being handled"""
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.robot_id = 0
+        self.published = []
+
+    def publish(self, topic, payload):
+        self.sim.command(self.robot_id, topic, payload)
+        self.published.append((topic, payload))
+
+
+class ControllerBackend:
+    """
+    Runs the real IoT_Controller.on_message in-process. The controller keeps its obstacle avoidance state in
+    module globals, so each robot's copy of those globals is swapped in before its messages are handled.
+    """
+
+    # the values controller.py starts up with, every robot begins from these
+    INITIAL_STATE = {
+        "inAutoMode": 0,
+        "moveInstruction": "move forward",
+        "ultraInstruction": "read forward",
+        "distanceLeft": -1,
+        "distanceRight": -1,
+        "distanceForward": 255,
+    }
+
+    def __init__(self, sim):
+        import controller # imported here so the fleet and broker backends don't need paho or the log file
+        logging.disable(logging.INFO) # keep the simulated traffic out of iot_controller.log
+        self.controller = controller
+        self.sim = sim
+        self.client = FakeClient(sim)
+        controller.IoT_Controller.client = self.client
+        self.states = [dict(self.INITIAL_STATE) for _ in range(sim.n_robots)]
+        self.latencies = []
+        self.cpu = 0.0
+        self.stdout = io.StringIO()
+
+    def deliver(self, robot_id, topic, payload):
+        for name, value in self.states[robot_id].items():
+            setattr(self.controller, name, value)
+        self.client.robot_id = robot_id
+        self.client.published = []
+        with redirect_stdout(self.stdout):
+            self.controller.IoT_Controller.on_message(self.client, None, FakeMessage(topic, payload))
+        self.states[robot_id] = {name: getattr(self.controller, name) for name in self.INITIAL_STATE}
+        # the broker would echo the controller's own publications back to it since it subscribes to "#"
+        for echo_topic, echo_payload in self.client.published:
+            with redirect_stdout(self.stdout):
+                self.controller.IoT_Controller.on_message(self.client, None, FakeMessage(echo_topic, echo_payload))
+        self.stdout.seek(0)
+        self.stdout.truncate()
+
+    def start(self):
+        for robot_id in range(self.sim.n_robots):
+            self.deliver(robot_id, START_TOPIC, "begin obstacle avoidance")
+
+    def handle(self, distances):
+        for robot_id, value in enumerate(distances.tolist()):
+            cpu_start = time.process_time()
+            start = time.perf_counter()
+            self.deliver(robot_id, DISTANCE_TOPIC, value)
+            self.latencies.append(time.perf_counter() - start)
+            self.cpu += time.process_time() - cpu_start
+
+
+class FleetBackend:
+    """Decides for every robot at once with fleet_decision.FleetDecision, one tick per ESP publish period"""
+
+    def __init__(self, sim):
+        from fleet_decision import FleetDecision
+        self.sim = sim
+        self.fleet = FleetDecision(sim.n_robots)
+        self.ids = np.arange(sim.n_robots)
+        self.latencies = []
+        self.cpu = 0.0
+
+    def publish(self):
+        for robot_id, move, ultra in self.fleet.instructions(self.ids):
+            self.sim.command(robot_id, DRIVE_TOPIC, move)
+            self.sim.command(robot_id, ULTRA_TOPIC, ultra)
+
+    def start(self):
+        self.fleet.begin_obstacle_avoidance(self.ids)
+        self.publish()
+
+    def handle(self, distances):
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        self.fleet.tick(self.ids, distances)
+        elapsed = time.perf_counter() - start
+        self.cpu += time.process_time() - cpu_start
+        # every robot waited for the whole tick, so that is each one's decision latency
+        self.latencies.extend([elapsed] * len(distances))
+        self.publish()
+
+
+def process_cpu_seconds(pid):
+    """utime + stime of another process from /proc, used to measure a controller running as its own service"""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+class BrokerBackend:
+    """
+    Talks to a controller through a real MQTT broker in real time, on the same topics as the real robot.
+    controller.py only knows those topics, so this is limited to one robot until it supports more.
+    """
+
+    def __init__(self, sim, broker="localhost", port=1883, controller_pid_file="/var/lib/iot_system/controller.pid"):
+        import paho.mqtt.client as mqtt
+        if sim.n_robots != 1:
+            raise ValueError(f"the broker backend runs one robot, not {sim.n_robots}: controller.py only answers on the plain robot/ topics")
+        self.sim = sim
+        self.commands = queue.Queue()
+        self.published_at = {}
+        self.latencies = []
+        self.cpu = 0.0
+        self.controller_pid = None
+        try:
+            with open(controller_pid_file) as f:
+                self.controller_pid = int(f.read().strip())
+        except (FileNotFoundError, ValueError):
+            print("⚠ Controller PID file not found, controller CPU will not be measured")
+
+        self.client = mqtt.Client(client_id="robot-simulator")
+        self.client.on_message = self.on_message
+        self.client.connect(broker, port, 60)
+        self.client.subscribe(DRIVE_TOPIC)
+        self.client.subscribe(ULTRA_TOPIC)
+        self.client.loop_start()
+
+    def on_message(self, client, userdata, message):
+        if message.topic in (DRIVE_TOPIC, ULTRA_TOPIC):
+            self.commands.put((time.perf_counter(), message.topic, message.payload.decode("utf-8")))
+
+    def drain(self):
+        while not self.commands.empty():
+            received, topic, payload = self.commands.get()
+            sent = self.published_at.pop(0, None)
+            if sent is not None and topic == DRIVE_TOPIC:
+                self.latencies.append(received - sent)
+            self.sim.command(0, topic, payload)
+
+    def start(self):
+        self.cpu_start = process_cpu_seconds(self.controller_pid) if self.controller_pid else 0.0
+        self.client.publish(START_TOPIC, "begin obstacle avoidance")
+
+    def handle(self, distances):
+        self.published_at[0] = time.perf_counter()
+        self.client.publish(DISTANCE_TOPIC, int(distances[0]))
+        time.sleep(TICK) # real robots publish every 100 ms, give the controller that long to answer
+        self.drain()
+        if self.controller_pid:
+            self.cpu = process_cpu_seconds(self.controller_pid) - self.cpu_start
+
+    def stop(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+def run(sim, backend, seconds):
+    """Run the simulation for the given simulated time and return the measurements"""
+    backend.start()
+    ticks = int(round(seconds / TICK))
+    for _ in range(ticks):
+        backend.handle(sim.step())
+    if hasattr(backend, "stop"):
+        backend.stop()
+
+    latencies = np.array(backend.latencies) if backend.latencies else np.zeros(1)
+    robot_minutes = sim.n_robots * ticks * TICK / 60
+    return {
+        "robots": sim.n_robots,
+        "sim_seconds": ticks * TICK,
+        "readings": sim.n_robots * ticks,
+        "latency_p50_us": float(np.percentile(latencies, 50) * 1e6),
+        "latency_p99_us": float(np.percentile(latencies, 99) * 1e6),
+        "latency_max_us": float(latencies.max() * 1e6),
+        "collisions": sim.collisions,
+        "collisions_per_robot_minute": sim.collisions / robot_minutes if robot_minutes else 0.0,
+        "controller_cpu_seconds": backend.cpu,
+        "controller_cpu_percent": 100 * backend.cpu / (ticks * TICK) if ticks else 0.0,
+    }
+
+
+BACKENDS = {"controller": ControllerBackend, "fleet": FleetBackend, "broker": BrokerBackend}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline robot simulator for controller performance tests")
+    parser.add_argument("--robots", type=int, nargs="+", help="fleet sizes to run (default 1 10 100 1000, just 1 for broker)")
+    parser.add_argument("--seconds", type=float, default=60.0, help="simulated time per run")
+    parser.add_argument("--backend", choices=BACKENDS, default="controller")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if args.robots is None:
+        args.robots = [1] if args.backend == "broker" else [1, 10, 100, 1000]
+    if args.backend == "broker" and args.robots != [1]:
+        parser.error("--backend broker only supports --robots 1, controller.py has no per-robot topics yet")
+
+    for n_robots in args.robots:
+        sim = RobotSimulator(n_robots, seed=args.seed)
+        results = run(sim, BACKENDS[args.backend](sim), args.seconds)
+        print(f"{args.backend}: {n_robots} robots, {results['sim_seconds']:.0f}s simulated, {results['readings']} readings")
+        print(f"  decision latency p50 {results['latency_p50_us']:.1f}us  p99 {results['latency_p99_us']:.1f}us  max {results['latency_max_us']:.1f}us")
+        print(f"  collisions {results['collisions']} ({results['collisions_per_robot_minute']:.2f} per robot-minute)")
+        print(f"  controller CPU {results['controller_cpu_seconds']:.3f}s ({results['controller_cpu_percent']:.1f}% of simulated time)")
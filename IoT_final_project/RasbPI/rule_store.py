@@ -0,0 +1,138 @@
+import json
+import os
+import sqlite3
+import time
+
+# Automation rules kept in SQLite instead of rewriting rules.json on every change.
+# Every rule has a stable id and a version. Edits and deletes have to say which version they started from,
+# so two people editing the same rule can't silently overwrite each other. Every change is also written to
+# rule_changes, which is how the controller reloads just the rules that changed.
+
+# absolute so every service opens the same file whatever directory it was started from, RULES_DB overrides it
+RULES_DB = os.environ.get("RULES_DB", "/var/lib/iot_system/rules.db")
+RULES_CHANGED_TOPIC = "system/rules/changed" # web.py publishes here after a change, the controller listens
+
+
+class RuleConflict(Exception):
+    """The rule was changed (or deleted) by someone else since it was loaded"""
+
+
+class RuleStore:
+
+    def __init__(self, db_file=RULES_DB, import_from=None):
+        self.db_file = db_file
+        self.import_from = import_from # old rules.json to copy in the first time the database is created
+        self._ready = False
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_file, timeout=5)
+        conn.row_factory = sqlite3.Row
+        if not self._ready:
+            self._create(conn)
+            self._ready = True
+        return conn
+
+    def _create(self, conn):
+        # BEGIN IMMEDIATE takes the write lock before checking whether rule_changes is empty, otherwise web.py
+        # and the controller starting together could both see an empty database and both import rules.json
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("""CREATE TABLE IF NOT EXISTS rules (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                version INTEGER NOT NULL,
+                                body TEXT NOT NULL,
+                                updated REAL NOT NULL)""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS rule_changes (
+                                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                                rule_id INTEGER NOT NULL,
+                                action TEXT NOT NULL)""")
+            empty = conn.execute("SELECT NOT EXISTS (SELECT 1 FROM rule_changes)").fetchone()[0]
+            if empty and self.import_from and os.path.exists(self.import_from):
+                with open(self.import_from, 'r') as file:
+                    for rule in json.load(file):
+                        self._insert(conn, rule)
+
+    def _insert(self, conn, rule):
+        cursor = conn.execute("INSERT INTO rules (version, body, updated) VALUES (1, ?, ?)",
+                              (json.dumps(rule), time.time()))
+        self._log(conn, cursor.lastrowid, "created")
+        return cursor.lastrowid
+
+    def _log(self, conn, rule_id, action):
+        conn.execute("INSERT INTO rule_changes (rule_id, action) VALUES (?, ?)", (rule_id, action))
+
+    def _check_version(self, conn, rule_id, version):
+        """Called when an UPDATE/DELETE matched nothing: None if the rule is gone, RuleConflict if it moved on"""
+        row = conn.execute("SELECT version FROM rules WHERE id = ?", (rule_id,)).fetchone()
+        if row is not None:
+            raise RuleConflict(f"Rule {rule_id} is at version {row['version']}, not {version}")
+        return None
+
+    @staticmethod
+    def _rule(row):
+        rule = json.loads(row['body'])
+        rule['id'] = row['id']
+        rule['version'] = row['version']
+        return rule
+
+    def all(self):
+        conn = self.connect()
+        rows = conn.execute("SELECT id, version, body FROM rules ORDER BY id").fetchall()
+        conn.close()
+        return [self._rule(row) for row in rows]
+
+    def get(self, rule_id):
+        conn = self.connect()
+        row = conn.execute("SELECT id, version, body FROM rules WHERE id = ?", (rule_id,)).fetchone()
+        conn.close()
+        return self._rule(row) if row else None
+
+    def create(self, rule):
+        """Add a rule and return its new id"""
+        conn = self.connect()
+        with conn:
+            rule_id = self._insert(conn, rule)
+        conn.close()
+        return rule_id
+
+    def update(self, rule_id, rule, version):
+        """Replace one rule if it is still at version. Returns the new version, or None if the rule doesn't exist."""
+        conn = self.connect()
+        try:
+            with conn:
+                cursor = conn.execute("UPDATE rules SET body = ?, version = version + 1, updated = ? WHERE id = ? AND version = ?",
+                                      (json.dumps(rule), time.time(), rule_id, version))
+                if cursor.rowcount == 0:
+                    return self._check_version(conn, rule_id, version)
+                self._log(conn, rule_id, "updated")
+                return version + 1
+        finally:
+            conn.close()
+
+    def delete(self, rule_id, version):
+        """Delete one rule if it is still at version. Returns True, or None if the rule doesn't exist."""
+        conn = self.connect()
+        try:
+            with conn:
+                cursor = conn.execute("DELETE FROM rules WHERE id = ? AND version = ?", (rule_id, version))
+                if cursor.rowcount == 0:
+                    return self._check_version(conn, rule_id, version)
+                self._log(conn, rule_id, "deleted")
+                return True
+        finally:
+            conn.close()
+
+    def last_change(self):
+        conn = self.connect()
+        seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM rule_changes").fetchone()[0]
+        conn.close()
+        return seq
+
+    def changes_since(self, seq):
+        """Ids of the rules changed after change number seq, and the newest change number"""
+        conn = self.connect()
+        rows = conn.execute("SELECT seq, rule_id FROM rule_changes WHERE seq > ? ORDER BY seq", (seq,)).fetchall()
+        conn.close()
+        if not rows:
+            return set(), seq
+        return {row['rule_id'] for row in rows}, rows[-1]['seq']
@@ -0,0 +1,180 @@
+import math
+import threading
+import historian_db
+
+# Statistics for many topics at once (count, min, max, mean, stddev, percentiles, last value).
+# A closed window (start and end) is one grouped SQL query over the typed value column.
+# The all-time window (no start, no end, what /api/stats gives by default) keeps growing, so it is kept in
+# OpenWindowCache and only the rows added since the last request are read. Any other window, or one too big
+# to keep in memory on the Pi, is queried like a closed one.
+
+PERCENTILES = (50, 90, 99)
+MAX_CACHED_ROWS = 100000 # a few MB of floats, past this the all-time window is queried instead of cached
+
+
+def window_clause(start_date, end_date):
+    where, params = "", []
+    if start_date:
+        where += " AND timestamp >= ?"
+        params.append(start_date)
+    if end_date:
+        where += " AND timestamp <= ?"
+        params.append(end_date)
+    return where, params
+
+def summary(count, numeric_count, minimum, maximum, mean, variance, percentiles, last_message, last_timestamp, last_value):
+    stddev = math.sqrt(max(variance, 0.0)) if numeric_count else None
+    return {
+        'count': count,
+        'numeric_count': numeric_count,
+        'min': minimum,
+        'max': maximum,
+        'mean': mean,
+        'stddev': stddev,
+        'percentiles': percentiles,
+        'last': {'message': last_message, 'timestamp': last_timestamp, 'value': last_value},
+    }
+
+def window_statistics(topics, start_date=None, end_date=None, percentiles=PERCENTILES):
+    """
+    Every topic's statistics in one query. Percentiles are nearest-rank, picked with a window function.
+    The variance is taken around the mean worked out first, AVG(value * value) - mean^2 falls apart for big values.
+    """
+    if not topics:
+        return {}
+    where, params = window_clause(start_date, end_date)
+    placeholders = ",".join("?" * len(topics))
+    # percentiles are ints checked by the caller, so they can go straight into the SQL
+    percentile_columns = ", ".join(f"MAX(CASE WHEN rn = ({int(p)} * n + 99) / 100 THEN value END) AS p{int(p)}" for p in percentiles)
+    rows = historian_db.query(f"""
+        WITH selected AS (
+            SELECT rowid, topic, value FROM historian_data
+            WHERE topic IN ({placeholders})""" + where + f"""
+        ),
+        ranked AS (
+            SELECT topic, value,
+                   ROW_NUMBER() OVER (PARTITION BY topic ORDER BY value) AS rn,
+                   COUNT(*) OVER (PARTITION BY topic) AS n
+            FROM selected WHERE value IS NOT NULL
+        ),
+        ranks AS (
+            SELECT topic{', ' + percentile_columns if percentiles else ''} FROM ranked GROUP BY topic
+        ),
+        means AS (
+            SELECT topic, AVG(value) AS mean FROM selected GROUP BY topic
+        ),
+        totals AS (
+            SELECT topic, COUNT(*) AS count, COUNT(value) AS numeric_count, MIN(value) AS minimum, MAX(value) AS maximum,
+                   means.mean, AVG((value - means.mean) * (value - means.mean)) AS variance, MAX(rowid) AS last_rowid
+            FROM selected JOIN means USING (topic) GROUP BY topic
+        )
+        SELECT totals.*, last.message, last.timestamp, last.value, ranks.*
+        FROM totals
+        JOIN historian_data AS last ON last.rowid = totals.last_rowid
+        LEFT JOIN ranks ON ranks.topic = totals.topic""", list(topics) + params)
+
+    results = {}
+    for row in rows:
+        topic, count, numeric_count, minimum, maximum, mean, variance, _, message, timestamp, value = row[:11]
+        ranks = dict(zip((f"p{int(p)}" for p in percentiles), row[12:]))
+        results[topic] = summary(count, numeric_count, minimum, maximum, mean, variance, ranks, message, timestamp, value)
+    return results
+
+
+class TopicAccumulator:
+    """
+    One topic's running statistics. Mean and variance are updated with Welford's method, which stays accurate
+    over long windows of large values. New values wait in a batch and are sorted into the rest when asked for percentiles.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.values = []
+        self.pending = []
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0 # sum of squared differences from the mean
+        self.last = (None, None, None)
+
+    def add(self, value, message, timestamp):
+        self.count += 1
+        self.last = (message, timestamp, value)
+        if value is not None:
+            self.pending.append(value)
+            self.n += 1
+            delta = value - self.mean
+            self.mean += delta / self.n
+            self.m2 += delta * (value - self.mean)
+
+    def sorted_values(self):
+        if self.pending:
+            # two sorted runs back to back, which sort() merges in one linear pass
+            self.pending.sort()
+            self.values += self.pending
+            self.values.sort()
+            self.pending = []
+        return self.values
+
+    def summary(self, percentiles):
+        values = self.sorted_values()
+        n = len(values)
+        # same nearest-rank rule as the SQL version
+        ranks = {f"p{p}": values[(p * n + 99) // 100 - 1] if n else None for p in percentiles}
+        return summary(self.count, n, values[0] if n else None, values[-1] if n else None,
+                       self.mean if n else None, self.m2 / n if n else None, ranks, *self.last)
+
+
+class OpenWindowCache:
+    """
+    Statistics over all of history, each request only reads the rows added since the last one.
+    Only the window with no start is cached: start is whatever the client sent, so caching per start would let
+    every different ?start= take up memory. Requests with a start go to window_statistics.
+    """
+
+    def __init__(self, max_rows=MAX_CACHED_ROWS):
+        self.max_rows = max_rows
+        self.seen = 0 # highest rowid read
+        self.topics = {} # topic -> TopicAccumulator
+        self.lock = threading.Lock()
+
+    def _count(self, topics):
+        placeholders = ",".join("?" * len(topics))
+        return historian_db.query(f"SELECT COUNT(*) FROM historian_data WHERE topic IN ({placeholders})", list(topics))[0][0]
+
+    def _read(self, topics, rowid_clause, rowid):
+        placeholders = ",".join("?" * len(topics))
+        rows = historian_db.query(f"""SELECT rowid, topic, value, message, timestamp FROM historian_data
+                                      WHERE {rowid_clause} AND topic IN ({placeholders}) ORDER BY rowid""",
+                                  [rowid] + list(topics))
+        for row_id, topic, value, message, timestamp in rows:
+            self.topics[topic].add(value, message, timestamp)
+        return rows[-1][0] if rows else None
+
+    def statistics(self, topics, start_date=None, percentiles=PERCENTILES):
+        if start_date is not None:
+            return window_statistics(topics, start_date, None, percentiles)
+        with self.lock:
+            # count before reading anything, topics that won't fit are never loaded into python
+            new_topics = [topic for topic in topics if topic not in self.topics]
+            cached_rows = sum(acc.count for acc in self.topics.values())
+            if new_topics and cached_rows + self._count(new_topics) > self.max_rows:
+                return window_statistics(topics, None, None, percentiles)
+
+            # topics new to the cache catch up to what the others have seen, then everyone gets the new rows
+            for topic in new_topics:
+                self.topics[topic] = TopicAccumulator()
+            if new_topics and self.seen:
+                self._read(new_topics, "rowid <= ?", self.seen)
+            last = self._read(list(self.topics), "rowid > ?", self.seen)
+            if last is not None:
+                self.seen = last
+
+            results = {topic: self.topics[topic].summary(percentiles) for topic in topics if self.topics[topic].count}
+            # topics with no rows aren't kept, and a cache that has grown past the limit since is started over
+            for topic in new_topics:
+                if not self.topics[topic].count:
+                    del self.topics[topic]
+            if sum(acc.count for acc in self.topics.values()) > self.max_rows:
+                self.topics = {}
+                self.seen = 0
+            return results
@@ -1,46 +1,84 @@
-from flask import Flask, render_template, request, send_file , redirect, url_for, flash
+from flask import Flask, render_template, request, send_file , redirect, url_for, flash, Response, g
 import csv
+import gzip
+import hashlib
 import io
 import sqlite3
-import plotly.graph_objs as go
-import plotly.offline as pyo
 from datetime import datetime
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 import json
 import os
-import requests
 import signal
-import paho.mqtt.client as mqtt
+import threading
+import time
+from health import HealthCache, HEALTH_TOPIC, heartbeat_age
+import historian_db
+from profiling import Profiler
+from topic_stats import window_statistics, window_clause, OpenWindowCache, PERCENTILES
+from rule_store import RuleStore, RuleConflict, RULES_DB, RULES_CHANGED_TOPIC
 
 looking_at_dashboard = True
 MQTT_BROKER = "localhost"  # Or your broker's IP/hostname
 MQTT_PORT = 1883
 TOPIC = "web/button/message"
 
-mqtt_client = mqtt.Client()
-mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)
-mqtt_client.loop_start()
+# latest heartbeat from each service, kept up to date by the subscription below
+health_cache = HealthCache()
+
+def on_connect(client, userdata, flags, rc):
+    client.subscribe(HEALTH_TOPIC + "/#")
+
+def on_message(client, userdata, msg):
+    if health_cache.handles(msg.topic):
+        health_cache.update(msg.topic, msg.payload.decode("utf-8"))
+
+mqtt_client = None
+mqtt_lock = threading.Lock()  # the threaded server can run two first requests at once, only one may create the client
+
+def start_mqtt():
+    """
+    Connect to the broker in the background. paho keeps retrying until it is up, so a dead broker doesn't stop the web app starting.
+    Called by create_app(), and before every request in case the app was started some other way (gunicorn web:app, flask run).
+    """
+    global mqtt_client
+    if mqtt_client is None:
+        with mqtt_lock:
+            if mqtt_client is None:
+                import paho.mqtt.client as mqtt  # imported on first use to keep startup fast
+                client = mqtt.Client()
+                client.on_connect = on_connect
+                client.on_message = on_message
+                client.connect_async(MQTT_BROKER, MQTT_PORT, 60)
+                client.loop_start()
+                mqtt_client = client
+    return mqtt_client
 
 # Monitoring files
 CONTROLLER_PID = "/var/lib/iot_system/controller.pid"
 CONTROLLER_HEARTBEAT = "/var/lib/iot_system/controller.heartbeat"
 HISTORIAN_HEARTBEAT = "/var/lib/iot_system/historian.heartbeat"
 
+def classify_age(age):
+    if age < 10:
+        return {'status': 'healthy', 'age': age}
+    elif age < 30:
+        return {'status': 'warning', 'age': age}
+    else:
+        return {'status': 'dead', 'age': age}
+
 def check_service_health(service_name, heartbeat_file):
-    """Check if a service is healthy by reading heartbeat"""
+    """Check if a service is healthy from its MQTT heartbeat, or by reading the heartbeat file if none has arrived"""
     try:
+        beat = health_cache.get(service_name)
+        if beat is not None:
+            status = classify_age(heartbeat_age(beat['timestamp']))
+            status['ingest_rate'] = beat.get('ingest_rate')
+            status['in_progress'] = beat.get('in_progress')
+            status['last_error'] = beat.get('last_error')
+            return status
         with open(heartbeat_file, 'r') as f:
-            last_beat = f.read().strip()
-            last_time = datetime.fromisoformat(last_beat)
-            age = (datetime.now() - last_time).seconds
-            
-            if age < 10:
-                return {'status': 'healthy', 'age': age}
-            elif age < 30:
-                return {'status': 'warning', 'age': age}
-            else:
-                return {'status': 'dead', 'age': age}
+            return classify_age(heartbeat_age(f.read().strip()))
     except FileNotFoundError:
         return {'status': 'missing', 'age': None}
     except Exception as e:
@@ -62,6 +100,10 @@ users = {
 app = Flask(__name__)
 app.secret_key = "change_this_to_a_random_secret"  # Required for session security
 
+@app.before_request
+def ensure_mqtt():
+    start_mqtt()  # no-op once connected, keeps the health subscription running however the app is served
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = "login"
@@ -76,30 +118,13 @@ def load_user(username):
         return User(username)
     return None
 
-RULES_FILE = 'rules.json'
+RULES_FILE = 'rules.json'  # only read once, to fill the rule store the first time
 
-def load_rules():
-    """Load rules from the JSON file"""
-    if not os.path.exists(RULES_FILE):
-        return []
-    try:
-        with open(RULES_FILE, 'r') as file:
-            return json.load(file)
-    except json.JSONDecodeError:
-        return []
-    except Exception as e:
-        print(f"Error loading rules: {e}")
-        return []
+rule_store = RuleStore(RULES_DB, import_from=RULES_FILE)
 
-def save_rules(rules):
-    """Save rules to the JSON file"""
-    try:
-        with open(RULES_FILE, 'w') as file:
-            json.dump(rules, file, indent=2)
-        return True
-    except Exception as e:
-        print(f"Error saving rules: {e}")
-        return False
+def notify_rules_changed(rule_id, action):
+    """Tell the controller which rule changed so it only reloads that one"""
+    start_mqtt().publish(RULES_CHANGED_TOPIC, json.dumps({'id': rule_id, 'action': action}))
 
 def convert_value(value_string):
     """Convert a string to a number if possible, otherwise keep as string"""
@@ -117,7 +142,7 @@ def convert_value(value_string):
 @login_required
 def list_rules():
     """Display all automation rules"""
-    rules = load_rules()
+    rules = rule_store.all()
     return render_template('rules_list.html', rules=rules)
 
 
@@ -142,10 +167,11 @@ def manual():
 
 @app.route('/publish/<msg>', methods=['POST'])
 def publish_message(msg):
+    client = start_mqtt()
     if msg == "begin obstacle avoidance": # alert both the Pi and the ESP that obstacle avoidance has begun so that they may reset 
-        mqtt_client.publish("robot/instruction-request", msg)
+        client.publish("robot/instruction-request", msg)
     else:
-        mqtt_client.publish("robot/manual-movement", msg)
+        client.publish("robot/manual-movement", msg)
     return ("", 204)
 
 
@@ -182,12 +208,12 @@ def create_rule():
         }
         
         # Add to rules and save
-        rules = load_rules()
-        rules.append(new_rule)
-        
-        if save_rules(rules):
+        try:
+            rule_id = rule_store.create(new_rule)
+            notify_rules_changed(rule_id, 'created')
             flash('Rule created successfully!', 'success')
-        else:
+        except sqlite3.Error as e:
+            print(f"Error saving rule: {e}")
             flash('Error saving rule.', 'danger')
         
         return redirect(url_for('list_rules'))
@@ -199,10 +225,10 @@ def create_rule():
 @login_required
 def edit_rule(rule_id):
     """Edit an existing rule"""
-    rules = load_rules()
+    rule = rule_store.get(rule_id)
     
     # Check if rule_id is valid
-    if rule_id < 0 or rule_id >= len(rules):
+    if rule is None:
         flash('Rule not found!', 'danger')
         return redirect(url_for('list_rules'))
     
@@ -226,46 +252,60 @@ def edit_rule(rule_id):
             'value': request.form['action_value'].strip()
         }
         
-        # Update the specific rule
-        rules[rule_id] = {
+        # Update the specific rule, as long as nobody else changed it since the form was loaded
+        updated_rule = {
             'conditions': conditions,
             'action': action
         }
         
-        if save_rules(rules):
-            flash('Rule updated successfully!', 'success')
-        else:
+        try:
+            if rule_store.update(rule_id, updated_rule, request.form.get('version', type=int)) is None:
+                flash('Rule not found!', 'danger')
+            else:
+                notify_rules_changed(rule_id, 'updated')
+                flash('Rule updated successfully!', 'success')
+        except RuleConflict:
+            flash('Someone else changed this rule while you were editing it. Check the latest version and try again.', 'danger')
+            return redirect(url_for('edit_rule', rule_id=rule_id))
+        except sqlite3.Error as e:
+            print(f"Error updating rule: {e}")
             flash('Error updating rule.', 'danger')
         
         return redirect(url_for('list_rules'))
     
     # GET request - show form pre-filled with existing rule
-    return render_template('rule_form.html', edit_mode=True, rule=rules[rule_id], rule_id=rule_id)
+    return render_template('rule_form.html', edit_mode=True, rule=rule, rule_id=rule_id)
 
 @app.route('/rules/delete/<int:rule_id>', methods=['GET', 'POST'])
 @login_required
 def delete_rule(rule_id):
     """Delete a rule after confirmation"""
-    rules = load_rules()
+    rule = rule_store.get(rule_id)
     
     # Check if rule_id is valid
-    if rule_id < 0 or rule_id >= len(rules):
+    if rule is None:
         flash('Rule not found!', 'danger')
         return redirect(url_for('list_rules'))
     
     if request.method == 'POST':
         # User confirmed deletion
-        deleted_rule = rules.pop(rule_id)
-        
-        if save_rules(rules):
-            flash(f'Rule deleted: {deleted_rule["action"]["message"]}', 'success')
-        else:
+        try:
+            if rule_store.delete(rule_id, request.form.get('version', type=int)) is None:
+                flash('Rule not found!', 'danger')
+            else:
+                notify_rules_changed(rule_id, 'deleted')
+                flash(f'Rule deleted: {rule["action"]["message"]}', 'success')
+        except RuleConflict:
+            flash('Someone else changed this rule since you opened it. Check it again before deleting.', 'danger')
+            return redirect(url_for('delete_rule', rule_id=rule_id))
+        except sqlite3.Error as e:
+            print(f"Error deleting rule: {e}")
             flash('Error deleting rule.', 'danger')
         
         return redirect(url_for('list_rules'))
     
     # GET request - show confirmation page
-    return render_template('rule_delete.html', rule=rules[rule_id], rule_id=rule_id)
+    return render_template('rule_delete.html', rule=rule, rule_id=rule_id)
 
 @app.route('/system/status')
 @login_required
@@ -278,6 +318,8 @@ def system_status():
 @login_required
 def reload_controller():
     """Send reload signal to IoT Controller"""
+    import requests  # only needed here, and slow to import
+    
     # Try HTTP method first (preferred)
     try:
         response = requests.post('http://localhost:5001/reload', timeout=5)
@@ -302,6 +344,51 @@ def reload_controller():
     
     return redirect(url_for('list_rules'))
 
+profiler = Profiler("web")
+
+@app.before_request
+def start_request_timer():
+    if profiler.running:
+        g.cpu_start = time.thread_time()
+
+@app.teardown_request
+def record_request_time(exc):
+    if profiler.running and 'cpu_start' in g:
+        profiler.record(f"request {request.endpoint}", time.thread_time() - g.cpu_start)
+
+@app.route('/debug/profile')
+@login_required
+def profile_report():
+    """Per-request CPU time and GC pauses since profiling started"""
+    return profiler.report()
+
+@app.route('/debug/profile/start', methods=['POST'])
+@login_required
+def profile_start():
+    if not profiler.start():
+        return {'error': 'profiling is already running'}, 409
+    return profiler.report()
+
+@app.route('/debug/profile/stop', methods=['POST'])
+@login_required
+def profile_stop():
+    """Stop profiling and save the results on the Pi, the report comes back in the response"""
+    try:
+        path = profiler.stop_and_dump()
+    except OSError as e:
+        return dict(profiler.report(), error=f'could not write profile: {e}'), 500
+    if path is None:
+        return {'error': 'profiling is not running'}, 409
+    report = profiler.report()
+    report['file'] = path
+    return report
+
+@app.route('/debug/profile/stacks')
+@login_required
+def profile_stacks():
+    """Collapsed stacks for flamegraph.pl or speedscope"""
+    return Response(profiler.collapsed_stacks(), mimetype='text/plain')
+
 @app.route('/logout')
 @login_required
 def logout():
@@ -312,19 +399,10 @@ def logout():
 
 
 def get_topics():
-    conn = sqlite3.connect('historian_data.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT DISTINCT topic FROM historian_data")
-    topics = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    return topics
+    return [row[0] for row in historian_db.query("SELECT DISTINCT topic FROM historian_data")]
 
 def get_data_for_topic(topic):
-    conn = sqlite3.connect('historian_data.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT timestamp, message FROM historian_data WHERE topic = ? ORDER BY timestamp", (topic,))
-    data = cursor.fetchall()
-    conn.close()
+    data = historian_db.query("SELECT timestamp, message FROM historian_data WHERE topic = ? ORDER BY timestamp", (topic,))
     
     timestamps = []
     values = []
@@ -338,76 +416,185 @@ def get_data_for_topic(topic):
     
     return timestamps, values
 
+def to_number(message):
+    try:
+        return float(message)
+    except ValueError:
+        return None
+
+def get_columns(topics, start_date=None, end_date=None):
+    """Timestamps and numeric values for each topic as two plain lists, ready for Plotly.js"""
+    where, params = window_clause(start_date, end_date)
+    columns = {}
+    for topic in topics:
+        rows = historian_db.query("SELECT timestamp, message FROM historian_data WHERE topic = ?" + where + " ORDER BY timestamp",
+                                  [topic] + params)
+        columns[topic] = {'t': [row[0] for row in rows], 'y': [to_number(row[1]) for row in rows]}
+    return columns
+
+# topics that hold a state until the next message rather than a measurement, these get forward-filled
+STATE_TOPICS = {
+    "robot/behaviour/drive",
+    "robot/behaviour/ultrasonic-sensor",
+    "robot/manual-movement",
+    "robot/instruction-request",
+}
+MAX_BUCKETS = 20000
+
+def get_aligned_frame(topics, bucket_seconds, start_date=None, end_date=None, state_topics=STATE_TOPICS):
+    """
+    All topics resampled onto the same time buckets in one query: the average for numeric topics, the last
+    message for state topics. State topics carry their last value forward through buckets with no message.
+    """
+    where, params = window_clause(start_date, end_date)
+    placeholders = ",".join("?" * len(topics))
+    # MAX(rowid) makes SQLite take the bare "message" column from the newest row in each bucket
+    rows = historian_db.query(f"""
+        SELECT datetime(CAST(strftime('%s', timestamp) AS INTEGER) / ? * ?, 'unixepoch') AS bucket,
+               topic,
+               AVG(value),
+               MAX(rowid),
+               message
+        FROM historian_data
+        WHERE topic IN ({placeholders})""" + where + """
+        GROUP BY bucket, topic
+        ORDER BY bucket""", [bucket_seconds, bucket_seconds] + list(topics) + params)
+
+    buckets = []
+    for bucket, *_ in rows:
+        if not buckets or buckets[-1] != bucket:
+            buckets.append(bucket)
+    if len(buckets) > MAX_BUCKETS:
+        raise ValueError(f"{len(buckets)} buckets, use a bucket wider than {bucket_seconds}s or a shorter range")
+
+    columns = {topic: [None] * len(buckets) for topic in topics}
+    i = -1
+    previous = None
+    for bucket, topic, average, _, last_message in rows:
+        if bucket != previous:
+            i += 1
+            previous = bucket
+        columns[topic][i] = last_message if topic in state_topics else average
+
+    for topic in topics:
+        if topic in state_topics:
+            column = columns[topic]
+            for j in range(1, len(column)):
+                if column[j] is None:
+                    column[j] = column[j - 1]
+    return buckets, columns
+
+def data_version(topics, start_date=None, end_date=None, *extra):
+    """ETag for a selection. The historian only appends, so the row count and newest rowid change whenever the data does."""
+    where, params = window_clause(start_date, end_date)
+    placeholders = ",".join("?" * len(topics))
+    count, last_rowid = historian_db.query(f"SELECT COUNT(*), MAX(rowid) FROM historian_data WHERE topic IN ({placeholders})" + where,
+                                           list(topics) + params)[0]
+    key = json.dumps([sorted(topics), start_date, end_date, count, last_rowid, *extra])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def cached_json(etag, build):
+    """JSON response that answers If-None-Match with a 304 before build() runs, gzipped when it is worth it"""
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        body = json.dumps(build(), separators=(',', ':')).encode()
+        response = Response(body, mimetype='application/json')
+        if 'gzip' in request.headers.get('Accept-Encoding', '') and len(body) > 1024:
+            response.set_data(gzip.compress(body, compresslevel=5))
+            response.headers['Content-Encoding'] = 'gzip'
+    # weak because the gzipped and plain bodies share it
+    response.set_etag(etag, weak=True)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'private, no-cache'  # browser keeps it, but checks the ETag each time
+    return response
+
+@app.route('/api/data')
+@login_required
+def api_data():
+    """Column arrays for ?topic=...&topic=... (all topics if none given), optionally limited to ?start=...&end=..."""
+    topics = request.args.getlist('topic') or get_topics()
+    start_date = request.args.get('start')
+    end_date = request.args.get('end')
+    etag = data_version(topics, start_date, end_date)
+    return cached_json(etag, lambda: {'topics': get_columns(topics, start_date, end_date)})
+
+@app.route('/api/overlay')
+@login_required
+def api_overlay():
+    """
+    Several topics on one time axis: ?topic=...&topic=...&bucket=<seconds>, optional ?start=...&end=...
+    Extra ?state=<topic> parameters mark more topics to forward-fill.
+    """
+    topics = request.args.getlist('topic') or get_topics()
+    bucket_seconds = request.args.get('bucket', 1, type=int)
+    if bucket_seconds < 1:
+        return {'error': 'bucket must be at least 1 second'}, 400
+    state_topics = STATE_TOPICS | set(request.args.getlist('state'))
+    start_date = request.args.get('start')
+    end_date = request.args.get('end')
+
+    def build():
+        buckets, columns = get_aligned_frame(topics, bucket_seconds, start_date, end_date, state_topics)
+        return {'t': buckets, 'bucket': bucket_seconds, 'topics': {topic: {'y': column} for topic, column in columns.items()}}
+
+    etag = data_version(topics, start_date, end_date, bucket_seconds, sorted(state_topics))
+    try:
+        return cached_json(etag, build)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+
 @app.route('/')
 @app.route('/plot/<start_date>/<end_date>')
 @login_required
 def plot_data(start_date=None, end_date=None):
     looking_at_dashboard = True
-    topics = get_topics()
-    traces = []
-    
-    # Add WHERE clause to SQL query
-    if start_date and end_date:
-        SQL = """SELECT timestamp, message FROM historian_data 
-                 WHERE topic = ? AND timestamp BETWEEN ? AND ? 
-                 ORDER BY timestamp"""
-        cursor.execute(SQL, (topic, start_date, end_date))
-    
-    for topic in topics:
-        timestamps, values = get_data_for_topic(topic)
-        if timestamps:
-            
-            
-                        # In your route
-            chart_type = request.args.get('type', 'line')
-
-            if chart_type == 'bar':
-                trace = go.Bar(x=timestamps, y=values, name=topic)
-            elif chart_type == 'scatter':
-                trace = go.Scatter(x=timestamps, y=values, mode='markers', name=topic)
-            else:
-                trace = go.Scatter(x=timestamps, y=values, mode='lines+markers', name=topic)
-            traces.append(trace)
-            
-    layout = go.Layout(
-        title='MQTT Historian Data',
-        xaxis=dict(title='Timestamp'),
-        yaxis=dict(title='Value'),
-        hovermode='closest'
-    )
-    
-    
-    
-    fig = go.Figure(data=traces, layout=layout)
-    graph_html = pyo.plot(fig, output_type='div', include_plotlyjs='cdn')
-    
-    return render_template('plot.html', graph=graph_html, looking_at_dashboard=looking_at_dashboard)
+    bucket = request.args.get('bucket', type=int)
+    if bucket:
+        # ?bucket=<seconds> overlays every topic on one aligned time axis
+        data_url = url_for('api_overlay', bucket=bucket, start=start_date, end=end_date)
+    else:
+        data_url = url_for('api_data', start=start_date, end=end_date)
+    return render_template('plot.html', data_url=data_url, title='MQTT Historian Data',
+                           chart_type=request.args.get('type', 'line'), looking_at_dashboard=looking_at_dashboard)
 
-@app.route('/topic/<topic_name>')
+@app.route('/topic/<path:topic_name>')
 @login_required
 def plot_single_topic(topic_name):
     looking_at_dashboard = False
-    timestamps, values = get_data_for_topic(topic_name)
-    trace = go.Scatter(x=timestamps, y=values, mode='lines+markers')
-    layout = go.Layout(title=f'Data for {topic_name}')
-    fig = go.Figure(data=[trace], layout=layout)
-    graph_html = pyo.plot(fig, output_type='div', include_plotlyjs='cdn')
-    
-    return render_template('plot.html', graph=graph_html, looking_at_dashboard=looking_at_dashboard)
+    data_url = url_for('api_data', topic=topic_name)
+    return render_template('plot.html', data_url=data_url, title=f'Data for {topic_name}',
+                           chart_type='line', looking_at_dashboard=looking_at_dashboard)
 
 def get_statistics(topic):
-    conn = sqlite3.connect('historian_data.db')
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT AVG(CAST(message AS REAL)), 
-               MIN(CAST(message AS REAL)), 
-               MAX(CAST(message AS REAL))
-        FROM historian_data 
-        WHERE topic = ?
-    """, (topic,))
-    avg, min_val, max_val = cursor.fetchone()
-    conn.close()
-    return {'average': avg, 'minimum': min_val, 'maximum': max_val}
+    stats = window_statistics([topic], percentiles=()).get(topic)
+    if stats is None:
+        return {'average': None, 'minimum': None, 'maximum': None}
+    return {'average': stats['mean'], 'minimum': stats['min'], 'maximum': stats['max']}
+
+# windows with no end keep getting new rows, these are updated incrementally instead of re-queried
+open_window_stats = OpenWindowCache()
+
+@app.route('/api/stats')
+@login_required
+def api_stats():
+    """
+    count, min, max, mean, stddev, percentiles and last value for ?topic=...&topic=... (all topics if none given)
+    over ?start=...&end=... (either can be left out). ?p=95&p=99 picks the percentiles, default 50/90/99.
+    """
+    topics = request.args.getlist('topic') or get_topics()
+    start_date = request.args.get('start')
+    end_date = request.args.get('end')
+    percentiles = request.args.getlist('p', type=int) or list(PERCENTILES)
+    if any(p < 1 or p > 100 for p in percentiles):
+        return {'error': 'percentiles must be between 1 and 100'}, 400
+
+    if end_date:
+        build = lambda: {'topics': window_statistics(topics, start_date, end_date, percentiles)}
+    else:
+        build = lambda: {'topics': open_window_stats.statistics(topics, start_date, percentiles)}
+    etag = data_version(topics, start_date, end_date, 'stats', percentiles)
+    return cached_json(etag, build)
 
 @app.route('/export/<topic>')
 @login_required
@@ -430,6 +617,13 @@ def export_csv(topic):
     )
 
 
+def create_app():
+    """Start the background pieces the routes rely on (MQTT, the profiling signal) and return the app"""
+    start_mqtt()
+    profiler.install_signal()  # kill -USR1 <pid> works here too
+    return app
+
+
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=True)
 